@@ -1,107 +1,219 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import os
+import sys
+import bisect
 import logging
+import platform
+
+# Windows console API, resolved once by install() rather than per record
+_k32 = None
+_HOUT = None
+_SetAttr = None
+
+# StreamHandler.emit as it was before install(), for uninstall()
+_original_emit = None
+
+def _load_console_api():
+    global _k32, _HOUT, _SetAttr
+    if _k32 is not None:
+        return
+    import ctypes
+    STD_OUTPUT_HANDLE = -11
+    _k32 = ctypes.windll.kernel32
+    _HOUT = _k32.GetStdHandle(STD_OUTPUT_HANDLE)
+    _SetAttr = _k32.SetConsoleTextAttribute
+    _SetAttr.argtypes = [ctypes.c_void_p, ctypes.c_uint16]
+
+def _enable_vt_mode():
+    """ let the console interpret ANSI escapes (Windows 10 and later), so
+    no API call is needed per record. False if the console can't."""
+    import ctypes
+    ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
+    mode = ctypes.c_uint32()
+    if not _k32.GetConsoleMode(_HOUT, ctypes.byref(mode)):
+        return False
+    return bool(_k32.SetConsoleMode(_HOUT,
+                                    mode.value | ENABLE_VIRTUAL_TERMINAL_PROCESSING))
+
+# ANSI: color and escape sequences:
+# https://stackoverflow.com/questions/4842424/list-of-ansi-color-escape-sequences
+ANSI_RESET = '\x1b[0m' # normal
+ANSI_CRITICAL_ERROR_COLOR = '\x1b[31;1m\033[7m' # bright red, reverse video
+ANSI_WARNING_COLOR = '\x1b[31;1m' # bright red
+ANSI_INFO_COLOR = '\033[32;1m' # bright green
+ANSI_DEBUG_COLOR = '\033[33;1m' # bright yellow
+
+# color for each of the six standard levels, looked up directly per record
+_ANSI_EXACT = {
+    logging.CRITICAL: ANSI_CRITICAL_ERROR_COLOR,
+    logging.ERROR: ANSI_CRITICAL_ERROR_COLOR,
+    logging.WARNING: ANSI_WARNING_COLOR,
+    logging.INFO: ANSI_INFO_COLOR,
+    logging.DEBUG: ANSI_DEBUG_COLOR,
+    logging.NOTSET: ANSI_RESET,
+}
+# ascending thresholds for custom levels, only where the color changes:
+# CRITICAL shares the ERROR color so it needs no threshold of its own
+_ANSI_THRESHOLDS = (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR)
+_ANSI_COLORS = (ANSI_RESET, ANSI_DEBUG_COLOR, ANSI_INFO_COLOR,
+                ANSI_WARNING_COLOR, ANSI_CRITICAL_ERROR_COLOR)
+
+def _resolve_ansi(levelno):
+    """ color for a non-standard level: that of the nearest level below it"""
+    return _ANSI_COLORS[bisect.bisect_right(_ANSI_THRESHOLDS, levelno)]
+
+# wincon.h
+FOREGROUND_BLACK     = 0x0000
+FOREGROUND_BLUE      = 0x0001
+FOREGROUND_GREEN     = 0x0002
+FOREGROUND_CYAN      = 0x0003
+FOREGROUND_RED       = 0x0004
+FOREGROUND_MAGENTA   = 0x0005
+FOREGROUND_YELLOW    = 0x0006
+FOREGROUND_GREY      = 0x0007
+FOREGROUND_INTENSITY = 0x0008 # foreground color is intensified.
+FOREGROUND_WHITE     = FOREGROUND_BLUE|FOREGROUND_GREEN |FOREGROUND_RED
+
+BACKGROUND_BLACK     = 0x0000
+BACKGROUND_BLUE      = 0x0010
+BACKGROUND_GREEN     = 0x0020
+BACKGROUND_CYAN      = 0x0030
+BACKGROUND_RED       = 0x0040
+BACKGROUND_MAGENTA   = 0x0050
+BACKGROUND_YELLOW    = 0x0060
+BACKGROUND_GREY      = 0x0070
+BACKGROUND_INTENSITY = 0x0080 # background color is intensified.
+
+# console attributes per level, combined here once instead of per record
+_WIN_CRITICAL = BACKGROUND_YELLOW | FOREGROUND_RED | FOREGROUND_INTENSITY | BACKGROUND_INTENSITY
+_WIN_ERROR = FOREGROUND_RED | FOREGROUND_INTENSITY
+_WIN_WARNING = FOREGROUND_YELLOW | FOREGROUND_INTENSITY
+_WIN_INFO = FOREGROUND_GREEN
+_WIN_DEBUG = FOREGROUND_MAGENTA
+
+_WIN_MAP = {
+    logging.CRITICAL: _WIN_CRITICAL,
+    logging.ERROR: _WIN_ERROR,
+    logging.WARNING: _WIN_WARNING,
+    logging.INFO: _WIN_INFO,
+    logging.DEBUG: _WIN_DEBUG,
+    logging.NOTSET: FOREGROUND_WHITE,
+}
+_WIN_THRESHOLDS = (logging.DEBUG, logging.INFO, logging.WARNING,
+                   logging.ERROR, logging.CRITICAL)
+_WIN_COLORS = (FOREGROUND_WHITE, _WIN_DEBUG, _WIN_INFO, _WIN_WARNING,
+               _WIN_ERROR, _WIN_CRITICAL)
+
+def _resolve_windows(levelno):
+    """ console attribute for a non-standard level, as in _resolve_ansi"""
+    return _WIN_COLORS[bisect.bisect_right(_WIN_THRESHOLDS, levelno)]
+
 # now we patch Python code to add color support to logging.StreamHandler
+def _set_color(code):
+    _SetAttr(_HOUT, code)
+
 def add_coloring_to_emit_windows(fn):
-        # add methods we need to the class
-    def _out_handle(self):
-        import ctypes
-        return ctypes.windll.kernel32.GetStdHandle(self.STD_OUTPUT_HANDLE)
-    out_handle = property(_out_handle)
-
-    def _set_color(self, code):
-        import ctypes
-        # Constants from the Windows API
-        self.STD_OUTPUT_HANDLE = -11
-        hdl = ctypes.windll.kernel32.GetStdHandle(self.STD_OUTPUT_HANDLE)
-        ctypes.windll.kernel32.SetConsoleTextAttribute(hdl, code)
-
-    setattr(logging.StreamHandler, '_set_color', _set_color)
-
-    def new(*args):
-        FOREGROUND_BLUE      = 0x0001 # text color contains blue.
-        FOREGROUND_GREEN     = 0x0002 # text color contains green.
-        FOREGROUND_RED       = 0x0004 # text color contains red.
-        FOREGROUND_INTENSITY = 0x0008 # text color is intensified.
-        FOREGROUND_WHITE     = FOREGROUND_BLUE|FOREGROUND_GREEN |FOREGROUND_RED
-       # winbase.h
-        STD_INPUT_HANDLE = -10
-        STD_OUTPUT_HANDLE = -11
-        STD_ERROR_HANDLE = -12
-
-        # wincon.h
-        FOREGROUND_BLACK     = 0x0000
-        FOREGROUND_BLUE      = 0x0001
-        FOREGROUND_GREEN     = 0x0002
-        FOREGROUND_CYAN      = 0x0003
-        FOREGROUND_RED       = 0x0004
-        FOREGROUND_MAGENTA   = 0x0005
-        FOREGROUND_YELLOW    = 0x0006
-        FOREGROUND_GREY      = 0x0007
-        FOREGROUND_INTENSITY = 0x0008 # foreground color is intensified.
-
-        BACKGROUND_BLACK     = 0x0000
-        BACKGROUND_BLUE      = 0x0010
-        BACKGROUND_GREEN     = 0x0020
-        BACKGROUND_CYAN      = 0x0030
-        BACKGROUND_RED       = 0x0040
-        BACKGROUND_MAGENTA   = 0x0050
-        BACKGROUND_YELLOW    = 0x0060
-        BACKGROUND_GREY      = 0x0070
-        BACKGROUND_INTENSITY = 0x0080 # background color is intensified.     
+    # most records in a build share a level: remember the last one resolved
+    last = [(None, None)]
 
+    def new(*args, _map=_WIN_MAP, _white=FOREGROUND_WHITE):
         levelno = args[1].levelno
-        if(levelno>=50):
-            color = BACKGROUND_YELLOW | FOREGROUND_RED | FOREGROUND_INTENSITY | BACKGROUND_INTENSITY 
-        elif(levelno>=40):
-            color = FOREGROUND_RED | FOREGROUND_INTENSITY
-        elif(levelno>=30):
-            color = FOREGROUND_YELLOW | FOREGROUND_INTENSITY
-        elif(levelno>=20):
-            color = FOREGROUND_GREEN
-        elif(levelno>=10):
-            color = FOREGROUND_MAGENTA
-        else:
-            color =  FOREGROUND_WHITE
-        args[0]._set_color(color)
-
-        ret = fn(*args)
-        args[0]._set_color( FOREGROUND_WHITE )
-        #print "after"
-        return ret
+        last_levelno, color = last[0]
+        if levelno != last_levelno:
+            color = _map.get(levelno)
+            if color is None:
+                color = _resolve_windows(levelno)
+            last[0] = (levelno, color)
+        _set_color(color)
+        try:
+            return fn(*args)
+        finally:
+            # reset even if the write fails
+            _set_color(_white)
     return new
 
+class ANSIColorFormatter(logging.Formatter):
+    """ Formatter that wraps each formatted line in the color for its level"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # most records in a build share a level: remember the last one resolved
+        self._last = (None, ANSI_RESET)
+
+    # the keyword defaults bind module globals as fast locals; never pass them
+    def format(self, record, _exact=_ANSI_EXACT, _resolve=_resolve_ansi,
+               _reset=ANSI_RESET):
+        s = super().format(record)
+        levelno = record.levelno
+        last_levelno, color = self._last
+        if levelno != last_levelno:
+            color = _exact.get(levelno) or _resolve(levelno)
+            self._last = (levelno, color)
+        # one BUILD_STRING, not two intermediate concatenations
+        return f"{color}{s}{_reset}"
+
 def add_coloring_to_emit_ansi(fn):
     # add methods we need to the class
-    def new(*args):
-        # ANSI: color and escape sequences:
-        # https://stackoverflow.com/questions/4842424/list-of-ansi-color-escape-sequences
-        levelno = args[1].levelno
-        if(levelno>=50): # CRITICAL
-            color = '\x1b[31;1m\033[7m' # bright red, reverse video
-        elif(levelno>=40): # ERROR
-            color = '\x1b[31;1m\033[7m' # bright red, reverse video
-        elif(levelno>=30): # WARNING
-            color = '\x1b[31;1m' # bright red
-        elif(levelno>=20): # INFO
-            color = '\033[32;1m' # bright green 
-        elif(levelno>=10): # DEBUG
-            color = '\033[33;1m' # bright yellow
-        else: # NOTSET
-            color = '\x1b[0m' # normal
-        args[1].msg = color + args[1].msg +  '\x1b[0m'  # normal
-        #print "after"
+    def new(*args, _color_formatter=ANSIColorFormatter):
+        handler = args[0]
+        # color the formatted output instead of rewriting record.msg, so
+        # the record reaches any other handler unchanged
+        if not isinstance(handler.formatter, _color_formatter):
+            fmt = handler.formatter or logging.Formatter()
+            handler.setFormatter(_color_formatter(fmt._fmt, fmt.datefmt))
         return fn(*args)
     return new
 
-import platform
-if platform.system()=='Windows':
-    # Windows does not support ANSI escapes and we are using API calls to set the console color
-    logging.StreamHandler.emit = add_coloring_to_emit_windows(logging.StreamHandler.emit)
-else:
-    # all non-Windows platforms are supporting ANSI escapes so we use them
-    logging.StreamHandler.emit = add_coloring_to_emit_ansi(logging.StreamHandler.emit)
-    #log = logging.getLogger()
-    #log.addFilter(log_filter())
-    #//hdlr = logging.StreamHandler()
-    #//hdlr.setFormatter(formatter())
+def _color_wanted():
+    """ only color a terminal; honor the NO_COLOR and FORCE_COLOR conventions"""
+    if os.environ.get('NO_COLOR'):
+        return False
+    if os.environ.get('FORCE_COLOR'):
+        return True
+    return sys.stderr.isatty()
+
+def ansi_color_available():
+    """ True if ANSI escapes will render on the terminal, i.e. a handler
+    can simply be given an ANSIColorFormatter. Turns on VT mode on Windows."""
+    if not _color_wanted():
+        return False
+    if platform.system()=='Windows':
+        _load_console_api()
+        return _enable_vt_mode()
+    return True
+
+def _has_color_formatter():
+    return any(isinstance(h.formatter, ANSIColorFormatter)
+               for h in logging.getLogger().handlers)
+
+def install():
+    """ patch StreamHandler to color its output, if it goes to a terminal.
+    Nothing is patched on import; call this once logging is configured.
+    A no-op if the root logger already colors through ANSIColorFormatter."""
+    global _original_emit
+    if _original_emit is not None or not _color_wanted():
+        return
+    if _has_color_formatter():
+        return
+    _original_emit = logging.StreamHandler.emit
+    windows = platform.system()=='Windows'
+    if windows:
+        _load_console_api()
+    if windows and not _enable_vt_mode():
+        # older Windows consoles do not support ANSI escapes, so we use API calls to set the console color
+        logging.StreamHandler.emit = add_coloring_to_emit_windows(logging.StreamHandler.emit)
+    else:
+        # all other platforms, and Windows 10 consoles in VT mode, support ANSI escapes so we use them
+        logging.StreamHandler.emit = add_coloring_to_emit_ansi(logging.StreamHandler.emit)
+        #log = logging.getLogger()
+        #log.addFilter(log_filter())
+        #//hdlr = logging.StreamHandler()
+        #//hdlr.setFormatter(formatter())
+
+def uninstall():
+    """ restore the original StreamHandler.emit. Handlers that already
+    emitted keep their ANSIColorFormatter."""
+    global _original_emit
+    if _original_emit is not None:
+        logging.StreamHandler.emit = _original_emit
+        _original_emit = None
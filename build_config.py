@@ -0,0 +1,24 @@
+""" build_config.py: frozen attribute view of the site configuration"""
+
+import keyword
+import logging
+from dataclasses import make_dataclass
+
+log = logging.getLogger(__name__)
+
+
+def freeze_config(global_dict):
+    """ return an immutable object with one slot per config key, for cheap
+    attribute access (cfg.src_root) in the build loops. Take it after all
+    runtime keys have been added to global_dict; the dict itself is still
+    what gets handed to the templates. Keys that can't be attribute names
+    ('blog-title', 'class') are left out: only templates see those."""
+    values = {}
+    for key, value in global_dict.items():
+        if isinstance(key, str) and key.isidentifier() and not keyword.iskeyword(key):
+            values[key] = value
+        else:
+            log.debug("config key %r is for templates only", key)
+    fields = [(key, object) for key in values]
+    Config = make_dataclass('Config', fields, frozen=True, slots=True)
+    return Config(**values)
@@ -6,14 +6,22 @@
 
 import os
 import sys
+import importlib.util
+import importlib.machinery
 from datetime import datetime
 import argparse
+import atexit
+import queue
 import logging
+import logging.handlers
 # color logging output to terminal
 import Colorer
 
 # local files:
 from content_tree import ContentTree
+from build_config import freeze_config
+
+log = logging.getLogger(__name__)
 
 DEFAULT_CONFIG = {
 
@@ -49,53 +57,97 @@ if __name__ == '__main__':
                         help='do not generate output')
     parser.add_argument('--verbose','-v',
                         action='store_true',
-                        help='verbose flag' )
+                        help='log debug messages too' )
     parser.add_argument('--incremental','-i',
                         action='store_true',
                         help='only render changed files' )
+    parser.add_argument('--jobs','-j',
+                        type=int, default=None,
+                        help='render pages in this many threads (default: one per CPU)' )
+    parser.add_argument('--processes',
+                        action='store_true',
+                        help='render in worker processes instead of threads (needs fork)' )
+    parser.add_argument('--no-color',
+                        action='store_true',
+                        help='do not color log output' )
     parser.add_argument('config',  nargs='?',
                         help='configuration python file',
-                        type=argparse.FileType('r'),
                         default=None)
     args = parser.parse_args()
 
 
-    # set up logging
-    logging.basicConfig(level=logging.DEBUG)
+    # set up logging: a single stream handler whose formatter does the
+    # coloring, replacing whatever handlers were configured before
+    handler = logging.StreamHandler()
+    if not args.no_color and Colorer.ansi_color_available():
+        handler.setFormatter(Colorer.ANSIColorFormatter(logging.BASIC_FORMAT))
+    level = logging.DEBUG if args.verbose else logging.INFO
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+    if not args.no_color:
+        # only patches consoles without ANSI support (older Windows)
+        Colorer.install()
+
+    # hand records to a background thread so the build never waits on
+    # terminal writes; the listener drains the queue at exit
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    stream_handler = root_logger.handlers[0]
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener = logging.handlers.QueueListener(log_queue, stream_handler,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
 
     if args.config is not None:
-        print("reading config file {}".format(args.config.name))
-        exec(args.config.read())
+        print("reading config file {}".format(args.config))
+        # import the config as a module so its bytecode is cached in
+        # __pycache__; any file name works, not just *.py
+        loader = importlib.machinery.SourceFileLoader('site_config', args.config)
+        spec = importlib.util.spec_from_file_location('site_config', args.config,
+                                                      loader=loader)
+        site_config = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(site_config)
         try:
-            foo = global_dict['src_root']
-        except (NameError, KeyError) as e:
-            logging.error("error parsing config file. Bye.")
-            raise e
-            exit(1)
+            global_dict = site_config.global_dict
+            global_dict['src_root']
+        except (AttributeError, KeyError) as e:
+            log.error("error parsing config file (%r). Bye.", e)
+            sys.exit(1)
     else:
-        logging.debug("Using default config")
+        log.debug("Using default config")
         # default dict defined at top of this file
         global_dict = DEFAULT_CONFIG
 
-   
-
-    #print(global_dict['src_root'])
-
-    global_dict['update_time'] = datetime.now().replace(microsecond=0).isoformat()
-    now = datetime.now()
+    # read the clock once; every timestamp in the build derives from it
+    now = datetime.now().replace(microsecond=0)
+    global_dict['build_time'] = now
+    global_dict['update_time'] = now.isoformat()
     global_dict['render_year'] = str(now.year)
 
     global_dict['incremental'] = args.incremental
+    global_dict['config_file'] = args.config
+    global_dict['jobs'] = args.jobs
+    global_dict['processes'] = args.processes
+
+    # no more keys are added from here on, so freeze a fast attribute view
+    cfg = freeze_config(global_dict)
 
-    ctree = ContentTree(global_dict)
+    ctree = ContentTree(global_dict, cfg)
     ctree.slurp_walk() # walk the content directory, reading the data files
     ctree.munge_loop() # generate tags and cross-links
     if args.dry_run:
-        logging.info("dry run: no output files generated.")
+        log.info("dry run: no output files generated.")
     else:
         ctree.dump_loop() #generate output
-        if 'rss_file' in global_dict.keys():
-            ctree.generate_rss()
-        ctree.generate_upload_script()
+        # nothing re-rendered, added, removed or retagged and no file
+        # written: feed and manifest stand
+        if (args.incremental and not ctree.changed_pages
+                and not ctree.updated and not ctree.index_changed):
+            log.info("No changes; skipping RSS and upload script")
+        else:
+            if global_dict.get('rss_file'):
+                ctree.generate_rss()
+            ctree.generate_upload_script()
+        ctree.save_build_state()
 
 
@@ -1,18 +1,134 @@
 import os
+import json
+import hashlib
 import logging
+import logging.handlers
+import operator
+from array import array
+import multiprocessing
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime as dt
+import mako
 from mako.template import Template
 from mako.lookup import TemplateLookup
 from mako import exceptions
+import mako.cache
 
+import page_unit
 from page_unit import PageUnit
+from build_config import freeze_config
+
+log = logging.getLogger(__name__)
+
+# config keys that change every run without changing what a page renders to
+_VOLATILE_KEYS = ('build_time', 'update_time', 'render_year', 'incremental',
+                  'config_file', 'jobs', 'processes')
+
+# the tree being built. Forked workers inherit it, so only page
+# indices and results cross the process boundary.
+_render_tree = None
+
+class _LazyTemplateDict(Mapping):
+    """ template name -> mako Template, compiled on first lookup so a
+    build only pays for the templates it uses"""
+    def __init__(self, paths, **template_args):
+        self.paths = paths # template name -> file name
+        self._template_args = template_args
+        self._templates = {}
+
+    def __getitem__(self, key):
+        template = self._templates.get(key)
+        if template is None:
+            template = Template(filename=self.paths[key], **self._template_args)
+            self._templates[key] = template
+        return template
+
+    def __contains__(self, key):
+        # don't compile a template just to test for it
+        return key in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+class _BuildCache(mako.cache.CacheImpl):
+    """ Mako cache backend that keeps output for the rest of the build
+    (per process; each ContentTree starts it empty). A def marked
+    cached="True" renders once and is reused by every page, so it must
+    depend only on values all pages share: the config, level1, level2
+    and tag_dict."""
+    _store = {}
+
+    def get_or_create(self, key, creation_function, **kw):
+        key = (self.cache.id, key)
+        value = self._store.get(key)
+        if value is None:
+            value = self._store[key] = creation_function()
+        return value
+
+    def set(self, key, value, **kw):
+        self._store[(self.cache.id, key)] = value
+
+    def get(self, key, **kw):
+        return self._store.get((self.cache.id, key))
+
+    def invalidate(self, key, **kw):
+        self._store.pop((self.cache.id, key), None)
+
+mako.cache.register_plugin('build', __name__, '_BuildCache')
+
+class _ForwardHandler(logging.Handler):
+    """ hand records from render workers to the parent's own loggers"""
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+def _init_render_worker(log_queue):
+    # the parent's log listener thread doesn't survive the fork
+    logging.getLogger().handlers = [logging.handlers.QueueHandler(log_queue)]
+
+def _parse_page(i):
+    punit = _render_tree.pages[i]
+    punit.read_content()
+    entry = page_unit.content_cache[punit.content_file]
+    return punit.content_file, entry, page_unit.markdown_cache[entry[3]]
+
+def _render_page(i):
+    punit = _render_tree.pages[i]
+    punit.render(_render_tree.template_dict, _render_tree.page_dict)
+    # the entry for an unchanged output may be new too, e.g. a touched mtime
+    hashes = {f: page_unit.output_hashes[f]
+              for f in (punit.dest_file, *punit.modified)
+              if f in page_unit.output_hashes}
+    return (i, punit.dest_file, punit.modified,
+            punit.ldict['content_html'], punit.ldict['images'], hashes)
 
 
 class ContentTree(object):
-    def __init__(self, global_dict):
+    def __init__(self, global_dict, cfg=None):
         self.gdict = global_dict
-        self.src_root = global_dict['src_root']
-        self.dest_root = global_dict['dest_root']
+        # attribute view of global_dict for lookups in the build loops
+        if cfg is None:
+            cfg = freeze_config(global_dict)
+        self.cfg = cfg
+        # cleared below if templates or config changed since the last build
+        self.incremental = cfg.incremental
+        # workers for parsing and rendering: threads by default, or forked
+        # processes if asked
+        self.jobs = global_dict.get('jobs') or os.cpu_count() or 1
+        self.processes = global_dict.get('processes', False)
+        if (self.processes
+                and 'fork' not in multiprocessing.get_all_start_methods()):
+            log.warning("worker processes need fork(); using threads")
+            self.processes = False
+        self.src_root = cfg.src_root
+        self.dest_root = cfg.dest_root
+        # time this build started, resolved once by the caller
+        self.build_time = global_dict.get('build_time')
+        if self.build_time is None:
+            self.build_time = dt.now().replace(microsecond=0)
 
         self.pages = [] # list of pages
         self.page_dict = {} # dict of pages, referenced by uri
@@ -23,24 +139,65 @@ class ContentTree(object):
         # keep track of updated files for ftp script
         self.updated = []
         self.updated_tags = {}
+        # pages rendered this build, whether or not their output changed
+        self.changed_pages = []
+        # pages added, removed or retagged since the last build
+        self.index_changed = False
+
+        # digests of the output files from the last build
+        self.hashes_file = os.path.join(self.dest_root, '.build_hashes.json')
+        page_unit.load_output_hashes(self.hashes_file)
+        # files earlier builds listed for upload, not yet shipped
+        self.manifest_file = os.path.join(self.dest_root, '.build_manifest.json')
+        self.prev_updated = self.load_previous_manifest()
+        page_unit.set_markdown_backend(self.gdict.get('markdown_backend'))
+        # parsed content files from earlier builds
+        self.content_cache_file = os.path.join(self.dest_root, '.cache',
+                                               'content.json')
+        page_unit.load_content_cache(self.content_cache_file)
+
+        # tags of each page at the last build, to catch retagged/removed pages
+        self.tag_index_file = os.path.join(self.dest_root, '.tag_index.json')
+
+        # cached defs rendered for an earlier tree in this process are stale
+        _BuildCache._store.clear()
 
         # preload some templates
         self.template_dict = self.load_templates()
         for key in self.template_dict:
-            logging.info('found template "{}"'.format(key))
+            log.info('found template "%s"', key)
         if len(self.template_dict) == 0:
-            logging.error("Could not find templates, exiting")
-            logging.error("check template directory in config file")
+            log.error("Could not find templates, exiting")
+            log.error("check template directory in config file")
             exit(0)
+
+        # a template or config change can change any page. Compare their
+        # content with the last build's rather than their mtimes, which also
+        # change on a checkout or a save without edits.
+        self.env_hash_file = os.path.join(self.dest_root, '.build_env_hash')
+        self.env_hash = self.hash_env()
+        try:
+            with open(self.env_hash_file, encoding='utf-8') as f:
+                self.prev_env_hash = f.read().strip()
+        except OSError:
+            self.prev_env_hash = None
+        # decided here, before munge_loop skips work for up-to-date pages
+        if self.incremental and self.env_hash != self.prev_env_hash:
+            log.info("templates or config changed since the last build; "
+                     "rendering all pages")
+            self.incremental = False
                 
             
-    def goodpath(self, path):
-        """ return normalized relative path to root"""
-        if os.sep != '/':
-            path = '/'.join(path.split(os.sep))
-        abs_path =  os.path.abspath(path)
-        src_path = os.path.relpath(path, self.gdict['src_root'])
-        return 
+    def hash_env(self):
+        """ digest of everything besides the content that shapes the output:
+        the template files and the non-volatile config values"""
+        h = hashlib.blake2b(digest_size=16)
+        for name in sorted(self.template_dict):
+            with open(self.template_dict.paths[name], 'rb') as f:
+                h.update(f.read())
+        config = {k: v for k, v in self.gdict.items() if k not in _VOLATILE_KEYS}
+        h.update(json.dumps(config, sort_keys=True, default=str).encode())
+        return h.hexdigest()
 
     def load_templates(self, gdict = None):
         if gdict is None:
@@ -48,10 +205,32 @@ class ContentTree(object):
             
         # look for html files in template directory, make into mako templates
 
-        template_dir = os.path.abspath(self.gdict['template_dir'])
-        mylookup = TemplateLookup(directories=[template_dir])
-        logging.info("looking for templates in {}".format(self.gdict['template_dir']))
-        template_dict = {}
+        template_dir = os.path.abspath(self.cfg.template_dir)
+
+        # compile options of the site templates. strict: an undefined template
+        # variable raises NameError instead of rendering as empty. Set
+        # 'strict_undefined' False in the config to relax.
+        template_args = {'strict_undefined': gdict.get('strict_undefined', True),
+                         'cache_impl': 'build'}
+
+        # keep compiled templates as python modules between builds, with the
+        # rest of the build state: mako imports whatever it finds there, so it
+        # must not be a shared dir like /tmp. The cache dir is keyed on the
+        # template dir, the mako version and the compile options, so another
+        # template dir, a mako upgrade or a strict_undefined change never pick
+        # up each other's modules.
+        cache_key = hashlib.md5(repr((template_dir, mako.__version__,
+                                      sorted(template_args.items()))).encode()).hexdigest()
+        module_dir = os.path.join(self.dest_root, '.cache', 'mako', cache_key)
+        os.makedirs(module_dir, exist_ok=True)
+
+        # templates don't change during a build: skip the per-lookup stat
+        mylookup = TemplateLookup(directories=[template_dir],
+                                  module_directory=module_dir,
+                                  filesystem_checks=False,
+                                  cache_impl='build')
+        log.info("looking for templates in %s", self.cfg.template_dir)
+        paths = {}
         files = os.listdir(template_dir)
         for f in files:
             path, fname = os.path.split(f)
@@ -64,12 +243,11 @@ class ContentTree(object):
                 #     print(template.render())
                 # except:
                 #     print(exceptions.html_error_template().render())
-                template = Template(filename=uri,
-                                    lookup = mylookup,
-                                    strict_undefined=True) 
-#                                    module_directory='/tmp/mako_modules')
-                template_dict[root] = template
-        return template_dict
+                paths[root] = uri
+        return _LazyTemplateDict(paths,
+                                 lookup = mylookup,
+                                 module_directory=module_dir,
+                                 **template_args)
 
     ##############################################################
 
@@ -81,49 +259,105 @@ class ContentTree(object):
         if src_root is None:
             src_root = self.src_root
 
+        content_ext = self.cfg.content_ext
+
         # walk the directory tree.
-        for path, subdirs, files in os.walk(src_root, 
-                                            followlinks=True, 
-                                            topdown=True):
+        by_name = operator.attrgetter('name')
+        for path, subdirs, file_entries in self.scan_tree(src_root):
             
             # if there is a .txt file, it's a content file. Get the 
             # lexicographic first one
 
-            src_path = self.goodpath(path)
             content_file_count = 0
 
-            files.sort()
+            file_entries.sort(key=by_name)
+            files = [e.name for e in file_entries]
 
-            for cf in files:
-                root, ext = os.path.splitext(cf)
-                if ext == self.gdict['content_ext']:
-                    self.add_page(path, cf, subdirs, files)
+            for entry in file_entries:
+                cf = entry.name
+                # a dotfile such as ".md" has no extension, as for splitext
+                if cf.endswith(content_ext) and not cf.startswith('.'):
+                    self.add_page(path, entry, subdirs, files)
                     content_file_count += 1
 
             if content_file_count == 0:
                 # OK to have subdirs of crap, just make sure that's OK
-                if src_path is not None:
-                    logging.warning("no content file found in {}".format(src_path))
+                log.warning("no content file found in %s",
+                            page_unit._relpath_cached(path, src_root))
 
             if content_file_count > 1:
                 # May be OK but warn anyway
-                logging.warning("multiple content files found in {}".format(src_path))
-
-
-
-    def add_page(self, path, cf, subdirs, files):
-        """ Found a dir with a content file. Make a PageUnit,
-        process lightly and add to the page structures. """
-
-        punit = PageUnit(path, self.gdict)
+                log.warning("multiple content files found in %s",
+                            page_unit._relpath_cached(path, src_root))
+
+
+
+    def scan_tree(self, top):
+        """ yield (path, subdirs, file_entries) for top and every dir below
+        it, like os.walk(top, followlinks=True) but using the file type
+        scandir already returned instead of stat-ing each entry again.
+        Files are given as os.DirEntry objects so their stat can be reused."""
+        # an explicit stack rather than recursion, pushed in reverse so dirs
+        # come out in the same (pre-)order a recursive walk gives
+        stack = [top]
+        # (st_dev, st_ino) of every dir walked: a symlink back up the tree,
+        # or a second link to a dir, would otherwise add its pages again
+        try:
+            st = os.stat(top)
+            seen = {(st.st_dev, st.st_ino)}
+        except OSError:
+            return
+        while stack:
+            path = stack.pop()
+            try:
+                with os.scandir(path) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            subdirs = []
+            dir_entries = []
+            files = []
+            for entry in entries:
+                try:
+                    # follows symlinks, as followlinks=True did
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    subdirs.append(entry.name)
+                    dir_entries.append(entry)
+                else:
+                    files.append(entry)
+            yield path, subdirs, files
+            for entry in reversed(dir_entries):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                key = (st.st_dev, st.st_ino)
+                if key in seen:
+                    log.warning("skipping already walked dir %s", entry.path)
+                    continue
+                seen.add(key)
+                stack.append(entry.path)
+
+    def add_page(self, path, content_entry, subdirs, files):
+        """ Found a dir with a content file (an os.DirEntry). Make a
+        PageUnit, process lightly and add to the page structures. """
+
+        punit = PageUnit(path, self.gdict, cfg=self.cfg)
         if punit.num < 0: # if no number in the directory, then don't add
-            logging.warning("Skipping un-numbered path {}".format(path))
+            log.warning("Skipping un-numbered path %s", path)
             return
 
-        logging.info("New page found at at {0}".format(path))
+        log.info("New page found at at %s", path)
         
         # content file: read content from this txt file
-        punit.content_file = os.path.join(path,cf)  
+        punit.content_file = content_entry.path
+        # scandir's stat, so an incremental build needn't stat it again
+        st = content_entry.stat()
+        punit.content_mtime = st.st_mtime
+        punit.content_size = st.st_size
 
         punit.subdirs = subdirs # subdirs of this directory
 
@@ -139,50 +373,75 @@ class ContentTree(object):
     def munge_loop(self):
         """ walk through all pages and populate with parents, children
         do additional processing (collect tags, etc.)"""
-        self.level1 = [] # for blogs, this is the blog year
-        self.level2 = [] # for blogs, this is the blog year
-        self.tags = {} # dict of list of tags, keyed by tag
-        for punit in self.pages:
-            punit.populate(self.template_dict, self.page_dict)
-
-        for punit in self.pages:
-            if punit.level == 1:
-                self.level1.append(punit)
-            if punit.level == 2:
-                self.level2.append(punit)
+        # per-page columns in page order, so the scans and sorts below
+        # never touch the pages themselves
+        self._levels = array('b')
+        self._html_paths = []
+        # an up-to-date page won't be rendered: only its header is needed.
+        # Kept for dump_loop, which skips the same pages.
+        self._fresh = fresh = [self.incremental and punit.is_up_to_date()
+                               for punit in self.pages]
+        if self.processes and self.jobs > 1:
+            # markdown holds the GIL, so only processes help here
+            stale = [i for i, punit in enumerate(self.pages)
+                     if not fresh[i] and punit.content_file is not None
+                     and not punit.content_is_cached()]
+            if len(stale) > 1:
+                self.parse_processes(stale)
+        for punit, is_fresh in zip(self.pages, fresh):
+            punit.populate(self.template_dict, self.page_dict, is_fresh)
+            self._levels.append(punit.level)
+            self._html_paths.append(punit.html_path)
+
+        # page indices sorted by html_path: the order of PageUnit.__lt__
+        by_path = self._html_paths.__getitem__
+        def pages_at(indices):
+            return [self.pages[i] for i in sorted(indices, key=by_path)]
+
+        # for blogs, level1 is the blog years and level2 the posts
+        self.level1 = pages_at(i for i, lv in enumerate(self._levels) if lv == 1)
+        self.level2 = pages_at(i for i, lv in enumerate(self._levels) if lv == 2)
+
+        tag_indices = {}
+        for i, punit in enumerate(self.pages):
             for tag in punit.tags:
-                if tag in self.tags:
-                    self.tags[tag].append(punit)
+                if tag in tag_indices:
+                    tag_indices[tag].append(i)
                 else:
-                    self.tags[tag] = [punit]
-
-        self.level1.sort()
-        self.level2.sort()
+                    tag_indices[tag] = [i]
 
         #print(" ".join(p.html_path for p in self.level1))
 
-        # sort tags (topics) alphabetically
-        stags = sorted(self.tags.items())
+        # sort tags (topics) alphabetically, ignoring case
+        stags = sorted(tag_indices.items(), key=lambda x: x[0].lower())
 
-        self.tags = dict(stags)
+        # dict of list of pages, keyed by tag
+        self.tags = {t: pages_at(indices) for t, indices in stags}
 
-        for t, val in self.tags.items():
-            val.sort()
-            #print("tag {} has pages: ".format(t))
-            #for v in val:
-            #    print('    page: {}'.format(v.html_path))
         self.make_tag_pages()
         self.make_top_page()
 
+        # template variables common to every page, layered once into each
+        # page's ldict ahead of the globals; tag_dict is already in
+        # alphabetical order
+        shared = {'tag_dict': self.tag_dict,
+                  'level1': self.level1,
+                  'level2': self.level2}
+        every_page = self.pages + self.tag_pages
+        if self.top_page is not None:
+            every_page.append(self.top_page)
+        for punit in every_page:
+            punit.ldict.maps.insert(1, shared)
+
     def make_tag_pages(self):
         # make a virtual page for each tag, with links to the tagged pages
         from urllib import parse
+        tag_dest =  os.path.join(self.cfg.dest_root,'tags')
+        tag_path =  os.path.join(self.cfg.html_root,'tags')
         for t, val in self.tags.items():
-            val.sort()
+            # val was sorted by munge_loop
             slug = parse.quote_plus(t)
-            tag_dest =  os.path.join(self.gdict['dest_root'],'tags')
-            tag_path =  os.path.join(self.gdict['html_root'],'tags')
-            punit = PageUnit(tag_path, self.gdict)
+            punit = PageUnit(tag_path, self.gdict, virtual=True, cfg=self.cfg)
             punit.slug = slug
             punit.fname = "{}.html".format(slug)
             punit.tagname = t
@@ -200,7 +459,7 @@ class ContentTree(object):
         # make a virtual page for each tag, with links to the tagged pages
         self.top_page = None
         if 'top' in self.template_dict:
-            self.top_page = PageUnit(self.gdict['html_top'], self.gdict)
+            self.top_page = PageUnit(self.cfg.html_top, self.gdict, cfg=self.cfg)
             self.top_page.ldict['children'] = self.level1
             self.top_page.template = self.template_dict['top']
 
@@ -208,75 +467,214 @@ class ContentTree(object):
     def dump_loop(self):
         """ loop through list of pages and figure out pathname & children """
 
-        # sort tags so they are in alphabetical order
-        self.tag_dict = dict(sorted(self.tag_dict.items(), key=lambda x: x[0].lower()))
-                             
+        tag_index = {p.html_path: sorted(p.tags) for p in self.pages}
+        if self.incremental:
+            self.mark_retagged(tag_index)
+            # outputs munge_loop found current despite a touched source
+            page_unit.mark_outputs_current()
+
         # render a page for each child
-        for punit in self.pages:
-            punit.ldict['tag_dict'] = self.tag_dict
-            punit.ldict['level1'] = self.level1
-            punit.ldict['level2'] = self.level2
-            punit.render(self.template_dict, self.page_dict)
-            if len(punit.modified) > 0:
-                self.updated.extend(punit.modified)
-                for t in punit.tags:
-                    self.updated_tags[t] = True
+        todo = []
+        for i, punit in enumerate(self.pages):
+            if self.incremental:
+                if self._fresh[i]:
+                    continue
+                log.info("incrementally updated src file %s", punit.content_file)
+            todo.append(i)
+
+        # render no longer creates its own directory
+        self.make_dest_dirs([self.pages[i] for i in todo])
+
+        # pages only read shared state from here on, so they can render
+        # concurrently: in threads by default, or in processes if asked
+        if self.jobs > 1 and len(todo) > 1:
+            if self.processes:
+                self.render_processes(todo, self.jobs)
+            else:
+                self.render_threads(todo, self.jobs)
+        else:
+            for i in todo:
+                self.pages[i].render(self.template_dict, self.page_dict)
+
+        for i in todo:
+            punit = self.pages[i]
+            # a page can render to the same html while its title or date,
+            # which tag pages and the feed show, changed: count it anyway
+            self.changed_pages.append(punit)
+            self.updated.extend(punit.modified)
+            for t in punit.tags:
+                self.updated_tags[t] = True
 
         # render a page for each tag that references all tagged pages
+        if self.tag_pages:
+            tags_template = self.template_dict['tags']
         for punit in self.tag_pages:
             #punit.ldict['tags'] = self.tags
-            punit.ldict['tag_dict'] = self.tag_dict
-            punit.ldict['level1'] = self.level1
-            punit.ldict['level2'] = self.level2
-            punit.template = self.template_dict['tags']
-            if self.gdict['incremental']:
+            if self.incremental:
                 t = punit.tagname
-                if t in self.updated_tags.keys():
-                    punit.render(self.template_dict, self.page_dict)
-                    self.updated.append(punit.dest_file)
-                    logging.info("incrementally updated {}".format(punit.dest_file))
-            else:
-                punit.render(self.template_dict, self.page_dict)
+                # also catch a missing tag page, or one older than a member
+                mtimes = [c.content_mtime for c in punit.ldict['children']]
+                if (t not in self.updated_tags and
+                        punit.is_up_to_date(source_mtimes=mtimes)):
+                    log.debug("tag page %s is up to date", t)
+                    continue
+            punit.template = tags_template
+            punit.render(self.template_dict, self.page_dict)
+            self.updated.extend(punit.modified)
+            if self.incremental:
+                log.info("incrementally updated %s", punit.dest_file)
 
             #punit.print_my_paths()
 
 
         if self.top_page is not None:
-            self.top_page.ldict['tag_dict'] = self.tag_dict
-            self.top_page.ldict['level1'] = self.level1
-            self.top_page.ldict['level2'] = self.level2
             self.top_page.render(self.template_dict, self.page_dict)
+            self.updated.extend(self.top_page.modified)
 
+        page_unit.write_if_changed(self.tag_index_file,
+                                   json.dumps(tag_index, sort_keys=True) + "\n")
 
-    def generate_rss(self):
-        # generate rss file header
-        header_temp = self.template_dict['feed_header']
-   
-        rss_xml = header_temp.render(**self.gdict)
 
+    def mark_retagged(self, tag_index):
+        """ compare page tags with the last build's index and mark tags that
+        gained or lost a page, since their tag pages list it. Sets
+        index_changed if any page was added, removed or retagged."""
+        try:
+            with open(self.tag_index_file, encoding='utf-8') as f:
+                prev_index = json.load(f)
+        except (OSError, ValueError):
+            self.index_changed = True
+            return
+        self.index_changed = prev_index != tag_index
+        for html_path, prev_tags in prev_index.items():
+            tags = tag_index.get(html_path, ())
+            for t in set(prev_tags).symmetric_difference(tags):
+                self.updated_tags[t] = True
+        for html_path, tags in tag_index.items():
+            if html_path not in prev_index:
+                for t in tags:
+                    self.updated_tags[t] = True
+
+        # every tag page links to every tag: a tag added or gone changes all
+        prev_tags = set().union(*prev_index.values())
+        if prev_tags != self.tag_dict.keys():
+            log.info("set of tags changed; rendering all tag pages")
+            for t in self.tag_dict:
+                self.updated_tags[t] = True
+
+    def make_dest_dirs(self, punits):
+        """ create the output directory of each page about to be rendered,
+        plus those of the tag and top pages, in one pass. Only leaf dirs
+        are created: makedirs makes their parents on the way."""
+        dest_dirs = {os.path.normpath(self.cfg.dest_root)}
+        dest_dirs.update(os.path.normpath(p.dest_path) for p in punits)
+        dest_dirs.update(os.path.normpath(p.dest_path) for p in self.tag_pages)
+        if self.top_page is not None:
+            dest_dirs.add(os.path.normpath(self.top_page.dest_path))
+        # drop every dir that is an ancestor of another
+        ancestors = set()
+        for d in dest_dirs:
+            parent = os.path.dirname(d)
+            while parent not in ancestors and parent != d:
+                ancestors.add(parent)
+                d, parent = parent, os.path.dirname(parent)
+        for d in sorted(dest_dirs - ancestors):
+            os.makedirs(d, exist_ok=True)
+
+    def render_threads(self, indices, jobs):
+        """ render the pages at the given indices in a thread pool"""
+        def render(i):
+            self.pages[i].render(self.template_dict, self.page_dict)
+        with ThreadPoolExecutor(jobs) as ex:
+            # consume the results so a failed render raises here
+            for _ in ex.map(render, indices):
+                pass
+
+    def map_processes(self, fn, indices, jobs):
+        """ yield fn(i) for the given page indices, run in forked worker
+        processes that inherit this tree and log through the parent"""
+        global _render_tree
+        mp_ctx = multiprocessing.get_context('fork')
+        log_queue = mp_ctx.Queue()
+        listener = logging.handlers.QueueListener(log_queue, _ForwardHandler())
+        _render_tree = self
+        listener.start()
+        try:
+            with ProcessPoolExecutor(jobs, mp_context=mp_ctx,
+                                     initializer=_init_render_worker,
+                                     initargs=(log_queue,)) as ex:
+                chunksize = max(1, len(indices) // (jobs * 4))
+                yield from ex.map(fn, indices, chunksize=chunksize)
+        finally:
+            listener.stop()
+            _render_tree = None
+
+    def parse_processes(self, indices):
+        """ read and convert the content files of the pages at the given
+        indices in worker processes, filling the content caches so that
+        populate() finds them there"""
+        for content_file, entry, html in self.map_processes(
+                _parse_page, indices, self.jobs):
+            page_unit.content_cache[content_file] = entry
+            page_unit.markdown_cache[entry[3]] = html
+
+    def render_processes(self, indices, jobs):
+        """ render the pages at the given indices in forked worker processes,
+        then copy back the state later steps read from each page"""
+        for (i, dest_file, modified, content_html, images,
+             hashes) in self.map_processes(_render_page, indices, jobs):
+            punit = self.pages[i]
+            punit.dest_file = dest_file
+            punit.modified = modified
+            punit.ldict['content_html'] = content_html
+            punit.ldict['images'] = images
+            page_unit.output_hashes.update(hashes)
+
+    def generate_rss(self):
         #generate an entry for each page
-        entry_temp = self.template_dict['feed_entry']
-        for punit in self.pages:
-            rss_xml += entry_temp.render(**punit.ldict)
+        entries = self.pages
 
-        # terminate xml
-        rss_xml += "</feed>\n"
+        # one template holds the header, the loop over the entries and the
+        # closing tag: a single render call
+        feed_temp = self.template_dict['feed']
+        rss_xml = feed_temp.render(entries=entries, **self.gdict)
 
         #print(rss_xml)
 
-        rss_path = os.path.join(self.gdict['dest_root'], 
-                                self.gdict['rss_file'])
+        rss_path = os.path.join(self.cfg.dest_root, 
+                                self.cfg.rss_file)
                                  
-        with open(rss_path, "w", encoding='utf-8') as rss_file:
-            rss_file.write(rss_xml)
-        logging.info("wrote rss file {}".format(rss_path))
+        if page_unit.write_if_changed(rss_path, rss_xml):
+            log.info("wrote rss file %s", rss_path)
+            self.updated.append(rss_path)
            
 
-    def generate_upload_script(self):
+    def save_build_state(self):
+        """ persist what the next build needs to know about this one"""
+        page_unit.write_if_changed(self.env_hash_file, self.env_hash + "\n")
+        page_unit.save_output_hashes(self.hashes_file)
+        page_unit.save_content_cache(self.content_cache_file,
+                                     [p.content_file for p in self.pages])
+
+    def load_previous_manifest(self):
+        """ files listed by the last build's manifest, relative to dest_root"""
+        try:
+            with open(self.manifest_file, encoding='utf-8') as f:
+                return json.load(f)['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            return []
 
-        pass
-        # for u in self.updated:
-        #     print("updated {}".format(u))
+    def generate_upload_script(self):
+        """ list the files to upload in dest_root/.build_manifest.json, so a
+        deploy script can ship just those without walking the tree. Entries
+        accumulate across builds until the deploy removes the manifest."""
+        files = set(self.prev_updated)
+        files.update(os.path.relpath(u, self.dest_root) for u in self.updated)
+        manifest = {'built_at': self.build_time.isoformat(),
+                    'files': sorted(files)}
+        page_unit.write_if_changed(self.manifest_file,
+                                   json.dumps(manifest, indent=1) + "\n")
+        log.info("%d files to upload listed in %s", len(files), self.manifest_file)
 
 
 if __name__ == '__main__':
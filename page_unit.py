@@ -1,25 +1,357 @@
 """ pageunit.py: class to hold data and methods for single page in tree"""
 
 import os
+import re
 import sys
-import codecs
+import json
+import hashlib
 import markdown
-import glob
 import shutil
 import logging
+import functools
+import itertools
+import threading
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
+import operator
 from pathlib import Path
 from mako.template import Template
+from mako.runtime import Context
+
+from build_config import freeze_config
+
+# optional C markdown parser, used only if the config asks for it
+try:
+    import cmarkgfm
+    from cmarkgfm.cmark import Options as CmarkOptions
+except ImportError:
+    cmarkgfm = None
+
+log = logging.getLogger(__name__)
+
+# [digest, mtime_ns, size] of each output file we wrote, keyed by path.
+# ContentTree loads and saves this with the build, so an unchanged file is
+# recognized from its stat alone without reading it back.
+output_hashes = {}
+
+def load_output_hashes(path):
+    output_hashes.clear()
+    try:
+        with open(path, encoding='utf-8') as f:
+            output_hashes.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+def save_output_hashes(path):
+    with open(path, "w", encoding='utf-8') as f:
+        json.dump(output_hashes, f)
+
+# stat of each output found current although its content file was
+# touched, keyed by path. Only touched by mark_outputs_current, so
+# checking pages (e.g. in a dry run) never changes the output tree.
+unchanged_outputs = {}
+
+def mark_outputs_current():
+    """ bring the mtimes of unchanged_outputs up to date"""
+    for path, old_st in unchanged_outputs.items():
+        os.utime(path)
+        known = output_hashes.get(path)
+        if known is not None and known[1:] == [old_st.st_mtime_ns,
+                                               old_st.st_size]:
+            st = os.stat(path)
+            known[1:] = [st.st_mtime_ns, st.st_size]
+    unchanged_outputs.clear()
+
+# [mtime, size, header dict, markdown digest] of each content file parsed,
+# keyed by path. Loaded and saved by ContentTree like output_hashes, so an
+# unchanged content file is neither read nor run through markdown again.
+content_cache = {}
+
+# markdown html keyed by the digest of its source text, so a content file
+# that was touched (checkout, rsync) but not edited skips markdown too
+markdown_cache = {}
+
+# bump when the layout of the cache file changes
+_CONTENT_CACHE_FORMAT = 2
+
+def load_content_cache(path):
+    content_cache.clear()
+    markdown_cache.clear()
+    try:
+        with open(path, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return
+    # html from another markdown parser or version may differ: start over
+    if (isinstance(cache, dict)
+            and cache.get('format') == _CONTENT_CACHE_FORMAT
+            and cache.get('markdown') == _markdown_version):
+        content_cache.update(cache.get('pages', {}))
+        markdown_cache.update(cache.get('html', {}))
+
+def save_content_cache(path, content_files):
+    """ save the entries for content_files, dropping those of removed pages"""
+    pages = {f: content_cache[f] for f in content_files if f in content_cache}
+    html = {e[3]: markdown_cache[e[3]] for e in pages.values()
+            if e[3] in markdown_cache}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding='utf-8') as f:
+        json.dump({'format': _CONTENT_CACHE_FORMAT,
+                   'markdown': _markdown_version,
+                   'pages': pages, 'html': html}, f)
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _new_blake2b():
+    return hashlib.blake2b(digest_size=16)
+
+def _unchanged(path, digest, source_mtime=None):
+    """ True if path already holds content with this digest. Then it is
+    left alone, except that one older than source_mtime is touched so
+    incremental builds compare sources against this render."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    known = output_hashes.get(path)
+    if known is not None and known[1:] == [st.st_mtime_ns, st.st_size]:
+        old_digest = known[0]
+    else:
+        with open(path, 'rb') as f:
+            old_digest = hashlib.file_digest(f, _new_blake2b).hexdigest()
+    if old_digest != digest:
+        return False
+    if source_mtime is not None and st.st_mtime < source_mtime:
+        os.utime(path)
+        st = os.stat(path)
+    output_hashes[path] = [digest, st.st_mtime_ns, st.st_size]
+    return True
+
+def write_if_changed(path, text):
+    """ Write text as UTF-8 unless the file already holds exactly those
+    bytes. Returns True if the file was written."""
+    # the newlines a text-mode write would give, e.g. \r\n on Windows
+    if os.linesep != '\n':
+        text = text.replace('\n', os.linesep)
+    data = text.encode('utf-8')
+    digest = _digest(data)
+    if _unchanged(path, digest):
+        return False
+    with open(path, 'wb') as f:
+        f.write(data)
+    st = os.stat(path)
+    output_hashes[path] = [digest, st.st_mtime_ns, st.st_size]
+    return True
+
+def render_if_changed(path, template, variables, source_mtime=None):
+    """ Render template with variables as UTF-8 straight into a scratch
+    file beside path, so the page is never held in memory whole, then
+    move it into place unless path already holds exactly those bytes.
+    Returns True if path was written."""
+    head, tail = os.path.split(path)
+    # one scratch file per process and thread: two pages with the same slug
+    # in different dirs can render to the same path at once
+    tmp_path = os.path.join(head, '.%s.%d-%d.tmp' % (tail, os.getpid(),
+                                                     threading.get_ident()))
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            template.render_context(Context(f, **variables))
+        with open(tmp_path, 'rb') as f:
+            digest = hashlib.file_digest(f, _new_blake2b).hexdigest()
+        if _unchanged(path, digest, source_mtime):
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    st = os.stat(path)
+    output_hashes[path] = [digest, st.st_mtime_ns, st.st_size]
+    return True
+
+# roots and the working directory are fixed for the whole build, so a
+# (path, start) pair always gives the same answer
+@functools.lru_cache(maxsize=None)
+def _relpath_cached(path, start):
+    return os.path.relpath(path, start)
+
+@functools.lru_cache(maxsize=None)
+def _abspath_cached(path):
+    return os.path.abspath(path)
+
+@functools.lru_cache(maxsize=None)
+def _normpath_cached(path):
+    return os.path.normpath(path)
+
+# media copied next to each page, in the order they are copied and listed.
+# Suffixes match case-sensitively, in lower or upper case only.
+_MEDIA_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.webp',
+               '.mp3' , '.mp4', '.html', '.pdf', '.svg', '.FCStd')
+_MEDIA_RANK = {ext: i for i, ext in
+               enumerate(_MEDIA_EXTS + tuple(e.upper() for e in _MEDIA_EXTS))}
+_JS_RANK = {ext: i for i, ext in enumerate(('.js', '.pde', '.class'))}
+# at most this many media files of a page are copied at once
+_COPY_THREADS = 8
+# suffix -> (0 for media or 1 for scripts, rank): one lookup per file
+_COPY_CLASS = {ext: (1, rank) for ext, rank in _JS_RANK.items()}
+_COPY_CLASS.update((ext, (0, rank)) for ext, rank in _MEDIA_RANK.items())
+
+# the same directory names are parsed from several places, so memoize on
+# the last path component
+@functools.lru_cache(maxsize=None)
+def _num_slug(base):
+    # partition rather than split: no list of all the pieces
+    head, sep, rest = base.partition('.')
+    if not sep:
+        return -1., ""
+    try:
+        num = int(head)
+    except ValueError:
+        return -1, ""
+
+    # now find slug
+    return num, rest.partition('.')[0]
+
+# a page's destination path, its children's and the tag pages' all share
+# the same leading directories, so memoize on the whole relative path
+@functools.lru_cache(maxsize=None)
+def _html_rel_path(rel_path):
+    rel_html_path = ""
+    for d in rel_path.split(os.sep):
+        num, slug = _num_slug(os.path.basename(_normpath_cached(d)))
+        rel_html_path = os.path.join(rel_html_path, slug)
+    return rel_html_path
+
+def flatten_ldict(ldict):
+    """ a page's ChainMap of template variables as one plain dict, to pass
+    as keyword arguments: far cheaper than ** on the ChainMap itself,
+    which looks every key up through all the maps"""
+    variables = {}
+    for m in reversed(ldict.maps):
+        variables.update(m)
+    return variables
+
+# one markdown converter for the process, reset between pages, instead of
+# building a new one (extensions, patterns) per markdown.markdown() call.
+# Default options, so output is the same as markdown.markdown()'s.
+_MD = markdown.Markdown()
+
+def _python_markdown(text):
+    return _MD.reset().convert(text)
+
+# raw html passes through, as with Python-Markdown; footnotes as in its
+# 'extra' extension
+_CMARK_OPTIONS = 0
+if cmarkgfm is not None:
+    _CMARK_OPTIONS = CmarkOptions.CMARK_OPT_UNSAFE | CmarkOptions.CMARK_OPT_FOOTNOTES
+
+def _cmark_markdown(text):
+    return cmarkgfm.github_flavored_markdown_to_html(text, options=_CMARK_OPTIONS)
+
+# the converter in use, and what it is called in the content cache
+_markdown_to_html = _python_markdown
+_markdown_version = 'markdown ' + markdown.__version__
+
+def set_markdown_backend(name):
+    """ pick the markdown parser: 'markdown' (Python-Markdown, the default)
+    or 'cmark' (cmark-gfm, in C, much faster). The two render some markup
+    differently, so cmark is opt-in; without cmarkgfm we stay on markdown.
+    Call before load_content_cache."""
+    global _markdown_to_html, _markdown_version
+    if name in (None, 'markdown'):
+        _markdown_to_html = _python_markdown
+        _markdown_version = 'markdown ' + markdown.__version__
+    elif name == 'cmark':
+        if cmarkgfm is None:
+            log.warning("cmarkgfm is not installed, using Python-Markdown")
+            return
+        _markdown_to_html = _cmark_markdown
+        _markdown_version = 'cmarkgfm ' + getattr(cmarkgfm, '__version__', '')
+    else:
+        log.warning("unknown markdown_backend %r, using Python-Markdown", name)
+
+# content file header lines: "key: value", where the key is the line's
+# first word and ends in ':'. Lines starting with '#' are comments.
+# [^\S\n] is whitespace within a line.
+_HEADER_RE = re.compile(r'^(?!#)[^\S\n]*(\S*):(?:[^\S\n]+(.*))?$', re.MULTILINE)
+# the header line "content:", after which the markdown starts
+_CONTENT_RE = re.compile(r'^(?!#)[^\S\n]*:*content:+(?=\s|$)', re.MULTILINE)
+
+# anything Mako would treat as template syntax: expressions, tags, control
+# and comment lines, and backslash line continuations
+_MAKO_SYNTAX = re.compile(r'\$\{|<%|^[ \t]*(?:%|##)|\\\n', re.MULTILINE)
+
+@functools.lru_cache(maxsize=256)
+def _inline_template(source):
+    """ compiled Mako template for content html, reused for equal sources"""
+    return Template(source)
 
 class PageUnit(object):
     """ Holds all the info we need to generate/mess with a given page"""
-    def __init__(self, src_path, global_dict=None):
+    # fixed attribute set: smaller pages and faster attribute access
+    __slots__ = ('gdict', 'cfg', 'src_path', 'rel_path', 'num', 'slug',
+                 'html_rel_path', 'dest_path', 'html_path', 'title', 'ldict',
+                 'subdirs', 'files', 'tags', 'content_file', 'content_mtime',
+                 'content_size',
+                 'tagname', 'fname', 'modified', 'level', 'template',
+                 'template_name', 'parents', 'parent_slugs', 'children',
+                 'child_slugs', 'permalink', 'thumbnail', 'dest_file')
+
+    def __init__(self, src_path, global_dict=None, virtual=False, cfg=None):
+        """ virtual: a generated page (e.g. a tag page) with no source dir.
+        Its paths are left for the caller to set. cfg: the frozen view of
+        global_dict, shared by all pages of a build."""
 
         self.gdict = global_dict
-        
+        if cfg is None:
+            cfg = freeze_config(global_dict)
+        self.cfg = cfg
+
+        if virtual:
+            self.src_path = src_path
+            self.rel_path = ""
+            self.html_path = ""
+            self.num = -1.
+            self.slug = ""
+            self.html_rel_path = ""
+            self.dest_path = self.cfg.dest_root
+        else:
+            self.init_paths(src_path)
+
+        self.title = "Lorem Ipsum"
+        # local dictionary, add to stuff here for template rendering. Writes
+        # go to the page's own map; other lookups fall through to the
+        # globals, which are shared rather than copied per page
+        self.ldict = ChainMap({}, self.gdict)
+
+        # populate with some defaults
+        self.ldict['content_html'] = ""
+
+        self.subdirs = []
+        self.files = []
+        self.tags = []
+        self.content_file = None
+        self.content_mtime = None
+        self.content_size = None
+        self.tagname = None
+        self.fname = "index.html"
+
+        # for ftp/scp transfer script, list of all files associated with this
+        # page that have been modified and thus need copying to host. 
+        # file paths are in html relative path format
+        self.modified = []
+
+        #self.print_my_paths()
+
+    def init_paths(self, src_path):
          # this is the content source relative path to root
-        self.src_path =  os.path.abspath(src_path)
+        self.src_path =  _abspath_cached(src_path)
 
-        self.rel_path = os.path.relpath(src_path, self.gdict['src_root']) 
+        self.rel_path = _relpath_cached(src_path, self.cfg.src_root)
 
         self.html_path = ""  # this is the destination HTML relative path
         # make actual paths from relative paths by joining 
@@ -37,34 +369,12 @@ class PageUnit(object):
         #self.html_path = self.get_abs_html_path(html_rel_path)
 
         # filesystem path of source data in markdown format
-        self.dest_path = os.path.join(self.gdict['dest_root'], 
+        self.dest_path = os.path.join(self.cfg.dest_root, 
                                       self.html_rel_path)
         
         # local copy of html files
-        self.html_path = os.path.join(self.gdict['html_root'], 
+        self.html_path = os.path.join(self.cfg.html_root, 
                                       self.html_rel_path)
-        
-
-        self.title = "Lorem Ipsum"
-        # local dictionary, add to stuff here for template rendering 
-        self.ldict = self.gdict.copy()
-
-        # populate with some defaults
-        self.ldict['content_html'] = ""
-
-        self.subdirs = []
-        self.files = []
-        self.tags = []
-        self.content_file = None
-        self.tagname = None
-        self.fname = "index.html"
-
-        # for ftp/scp transfer script, list of all files associated with this
-        # page that have been modified and thus need copying to host. 
-        # file paths are in html relative path format
-        self.modified = []
-
-        #self.print_my_paths()
 
     # implement "<" operator for sorting
     def __lt__(self, other):
@@ -74,20 +384,11 @@ class PageUnit(object):
     def sort_subdirs(self, reverse=True):
         """ sort by descending slug number"""
 
-        if len(self.subdirs) < 2:
-            return
-
-        num = []
-        for d in self.subdirs:
-            n, slug = self.num_slug(d)
-            num.append(int(n))
-        
-        sort_order = sorted((e,i) for i,e in enumerate(num))
-        if reverse:
-            sort_order.reverse()
-        sorted_subdirs = [self.subdirs[i[1]] for i in sort_order]
-
-        self.subdirs = sorted_subdirs
+        # a new list: the walk still iterates the one we were given. Ties
+        # keep their reversed order, as the old (num, index) tuple sort did.
+        subdirs = self.subdirs[::-1] if reverse else list(self.subdirs)
+        subdirs.sort(key=lambda d: _num_slug(d)[0], reverse=reverse)
+        self.subdirs = subdirs
 
     def print_my_paths(self):
         print("-------src_path: {}".format(self.src_path))
@@ -97,91 +398,58 @@ class PageUnit(object):
 
     def get_html_path(self, rel_path):
         # remove numbering from source path for clean destination path
-        # return list of parents for breadcrumbs
-        #print("orig path: {}".format(rel_path))
-        
-        rel_html_path = ""
-        dirnames = rel_path.split(os.sep)
-        for d in dirnames:
-            num, slug = self.num_slug(d)
-            rel_html_path = os.path.join(rel_html_path,slug)
-        return rel_html_path
+        return _html_rel_path(rel_path)
 
 
 
     def get_abs_html_path(self, path, abs_root=None):
 
         if abs_root is None:
-            abs_root = self.gdict['html_root']
+            abs_root = self.cfg.html_root
 
         if len(path) < 1 :
             return abs_root
 
         #print("path {}, abs_root {}".format(path, abs_root))    
 
-        rel_html_path = os.path.relpath(path, abs_root)
-        abs_html_path = os.path.join(self.gdict['html_root'], rel_html_path) 
+        rel_html_path = _relpath_cached(path, abs_root)
+        abs_html_path = os.path.join(self.cfg.html_root, rel_html_path) 
         return abs_html_path
 
     def num_slug(self, pathname):
         # extract the index number of this pathname, e.g
         # 1.foo/2.bar/3.baz/haha.txt returns 3 (integer)
         # and the slug "baz"
-        path = os.path.normpath(pathname)
-        dirnames = path.split(os.sep)
-
-        if len(dirnames) < 1:
-            return -1., ""
-
-        base = dirnames[-1]
-        splits  = base.split('.')
-        num = -1
-
-        if len(splits) < 2:
-            return -1., ""
-        try:
-            num = int(splits[0])
-        except ValueError:
-            return -1, ""
+        return _num_slug(os.path.basename(_normpath_cached(pathname)))
 
-        # now find slug
-        return num, splits[1]
 
 
-
-    def parse_content_file(self, file_path):
+    def parse_content_file(self, file_path, header_only=False):
         """ read a content file, parse header info and content markdown, return
-        all in a dict"""
+        all in a dict. With header_only, leave out the markdown."""
 
         header_dict = {'content_raw':'', 'template':'default'}
         if file_path is None:
             return header_dict
 
-        # test if file exists
-        if not os.path.exists(file_path):
-            print("WARNING: no content file found in {}".format(file_path))
-            return header_dict
-
-        input_file = codecs.open(file_path, mode="r", encoding="utf-8")
-        lines = []
-        for line in input_file:
-            # use hash as comment
-            if line[0] !=  '#':
-                lines.append(line.strip())
-        input_file.close()    
-
         # parse text file until we hit "content:" -- the rest is markdown
         # header lines have first words ending in ':'
         try:
-            for i, line in enumerate(lines):
-                words = line.split()
-                if len(words) > 0:
-                    if words[0][-1] == ':':
-                        key = words[0].strip(':')
-                        if key == 'content':
-                            header_dict['content_raw'] = '\n'.join(lines[i+1:])
-                            return header_dict
-                        header_dict[key] = ' '.join(words[1:]) 
+            # the whole file in one read; a missing file is caught here
+            # rather than tested for first
+            text = Path(file_path).read_text(encoding="utf-8")
+            marker = _CONTENT_RE.search(text)
+            header = text if marker is None else text[:marker.start()]
+            for key, value in _HEADER_RE.findall(header):
+                header_dict[key.strip(':')] = ' '.join(value.split())
+            if marker is not None and not header_only:
+                # the body after the marker line, with comment lines
+                # dropped and each line stripped as above
+                body = text[marker.end():].partition('\n')[2].splitlines()
+                header_dict['content_raw'] = '\n'.join(
+                    l.strip() for l in body if l[:1] != '#')
+        except FileNotFoundError:
+            print("WARNING: no content file found in {}".format(file_path))
         except Exception as e:
             print("ERROR parsing content file {}".format(file_path)) 
             raise e
@@ -191,25 +459,37 @@ class PageUnit(object):
     def write_html_file_u(self, html_path, html):
         """ Write rendered unicode as UTF-8 to the given path"""
         ###print("writing content file {}".format(html_path))
-        hfile = codecs.open(html_path, "w", "utf-8")
-        hfile.write(html)
-        hfile.close()
-
-    def write_html_file(self, html_path, html):
-        """ Write rendered unicode as UTF-8 to the given path"""
-        logging.info("writing content file {}".format(html_path))
-        with open(html_path, "w", encoding='utf-8') as hfile:
-            try:
-                hfile.write(html)
-            except UnicodeEncodeError as e:
-                print("Error rendering content file {}".format(html_path))
-                print(e)
+        with open(html_path, "w", encoding="utf-8") as hfile:
+            hfile.write(html)
+
+    def render_html_file(self, html_path, variables):
+        """ Render this page's template as UTF-8 to the given path, unless
+        the file already has this content. Returns True if it was written."""
+        # what is_up_to_date compares the output's mtime with
+        if self.tagname is not None:
+            source_mtime = max((c.content_mtime for c in self.ldict['children']),
+                               default=None)
+        else:
+            source_mtime = self.content_mtime
+        try:
+            written = render_if_changed(html_path, self.template, variables,
+                                        source_mtime)
+        except UnicodeEncodeError as e:
+            print("Error rendering content file {}".format(html_path))
+            print(e)
+            return False
+        if written:
+            log.info("writing content file %s", html_path)
+        else:
+            log.info("unchanged content file %s", html_path)
+        return written
                 
     #########################################################
 
 
-    def populate(self, template_dict, page_dict):
-        """ add links to parents, children"""
+    def populate(self, template_dict, page_dict, fresh=False):
+        """ add links to parents, children. A fresh page (output up to date)
+        won't be rendered, so its markdown is skipped unless cached."""
         ###print("populating page: {}".format(self.html_path))
         self.ldict['html_path']  = self.html_path
 
@@ -226,20 +506,21 @@ class PageUnit(object):
             try:
                 self.children.append(page_dict[child_html_path])
             except KeyError:
-                logging.error(f"could not find child {child_html_path} for {self.html_path}")
+                log.error("could not find child %s for %s", child_html_path, self.html_path)
  
         # make parent paths for breadcrumb navigation:
         self.parent_slugs = self.html_rel_path.split(os.sep)
         self.parents = []
 
-        parent_html_path = self.gdict['html_root']
-        for slug in self.parent_slugs:
-
-            parent_html_path = os.path.join(parent_html_path,slug)
-            try:
-                self.parents.append(page_dict[parent_html_path])
-            except KeyError:
-                logging.error("could not find parent {}".format(parent_html_path))
+        # html_root/a, html_root/a/b, ... joined in one C-level pass
+        parent_paths = itertools.accumulate(self.parent_slugs, os.path.join,
+                                            initial=self.cfg.html_root)
+        for parent_html_path in itertools.islice(parent_paths, 1, None):
+            parent = page_dict.get(parent_html_path)
+            if parent is None:
+                log.error("could not find parent %s", parent_html_path)
+            else:
+                self.parents.append(parent)
 
 
         self.level = len(self.parents)
@@ -252,13 +533,13 @@ class PageUnit(object):
             root, ext = os.path.splitext(f)
             if root == 'thumb':
                 self.thumbnail = f
-        if self.thumbnail == "" and self.gdict['warn_thumbnail']:
-            logging.warning("WARNING: could not find thumb.* in {}".format(self.src_path))
+        if self.thumbnail == "" and self.cfg.warn_thumbnail:
+            log.warning("WARNING: could not find thumb.* in %s", self.src_path)
 
         self.ldict['keywords'] = 'no keywords found'
 
         # Parse content file and get dict of attributes from header
-        hdict = self.parse_content_file( self.content_file)
+        hdict, content_html = self.read_content(fresh)
 
         # set up the right template
         if hdict['template'] == 'default':
@@ -269,33 +550,25 @@ class PageUnit(object):
         else:
             self.template_name = hdict['template']
 
-        # extract tags
-        if 'tags' in hdict:
-            for t in hdict['tags'].split(','):
-                if len(t.strip()) > 0:
-                    self.tags.append(t.strip())
+        # extract tags: the comma-separated, non-blank names
+        stripped = (t.strip() for t in hdict.get('tags', '').split(','))
+        self.tags = [t for t in stripped if t]
 
-        # convert tag to list if a single string:
-        if isinstance(self.tags, str):
-            self.tags = [self.tags]
-            
         #if len(self.tags) > 0:
         #    logging.warning("tags for {}: ".format(self.html_path)  + ";".join(self.tags))
 
         try:
             self.template = template_dict[self.template_name]
         except KeyError:
-            logging.warning('WARNING: template "{}" not found, using leaf.'.format(self.template_name))
+            log.warning('WARNING: template "%s" not found, using leaf.', self.template_name)
             self.template = template_dict['leaf']
 
-        info_str = 'generating {}'.format(self.html_path)
-        #info_str += 'from {}'.format(self.src_path)
-        info_str += ' using "{}" template'.format(self.template_name)
-        logging.info(info_str)
+        log.info('generating %s using "%s" template',
+                 self.html_path, self.template_name)
 
 #        self.permalink = "http://"  + self.gdict['hostname'] + os.path.join(self.html_path, self.fname)
 
-        self.permalink = "http://"  + self.gdict['hostname'] + self.html_path
+        self.permalink = "http://"  + self.cfg.hostname + self.html_path
         
         self.ldict.update(hdict)
 
@@ -305,99 +578,192 @@ class PageUnit(object):
         self.ldict['tags'] = self.tags
         self.title = self.ldict['title']
 
+        self.ldict['content_html'] = content_html
 
-        try:
-            self.ldict['content_html'] = markdown.markdown(hdict['content_raw'])
-        except Exception as e:
-            logging.error("parsing markdown in {}".format(self.content_file)) 
-            raise e
+    def read_content(self, fresh=False):
+        """ header dict and markdown html of the content file, taken from
+        content_cache if the file is unchanged since it was last parsed.
+        If fresh, a cache miss reads only the header and gives no html."""
+        if self.content_is_cached():
+            cached = content_cache[self.content_file]
+            return cached[2], markdown_cache[cached[3]]
+        if fresh:
+            return self.parse_content_file(self.content_file, header_only=True), ""
+
+        hdict = self.parse_content_file( self.content_file)
+        content_raw = hdict['content_raw']
+        md_key = _digest(content_raw.encode('utf-8'))
+        content_html = markdown_cache.get(md_key)
+        if content_html is None:
+            try:
+                content_html = _markdown_to_html(content_raw)
+            except Exception as e:
+                log.error("parsing markdown in %s", self.content_file) 
+                raise e
+            markdown_cache[md_key] = content_html
+        if self.content_file is not None:
+            content_cache[self.content_file] = [self.content_mtime,
+                                                self.content_size, hdict, md_key]
+        return hdict, content_html
+
+    def content_is_cached(self):
+        """ True if read_content can answer from the caches"""
+        cached = content_cache.get(self.content_file)
+        return (cached is not None
+                and cached[0] == self.content_mtime
+                and cached[1] == self.content_size
+                and cached[3] in markdown_cache)
 
 
     #########################################################
 
 
+    def is_up_to_date(self, source_mtimes=None):
+        """ True if the output file exists and is no older than any of the
+        source_mtimes, which default to this page's content file mtime.
+        Template and config changes are caught by the build's env hash."""
+        dest_file = os.path.join(self.dest_path, self.fname)
+        try:
+            dest_stat = os.stat(dest_file)
+        except OSError:
+            return False
+        dest_mtime = dest_stat.st_mtime
+        if source_mtimes is not None:
+            return max(source_mtimes, default=0.) <= dest_mtime
+        if not self.content_mtime or self.content_mtime <= dest_mtime:
+            return True
+        # the content file is newer, but may just have been touched
+        # (checkout, rsync) without being edited
+        return self.content_unchanged(dest_file, dest_stat)
+
+    def content_unchanged(self, dest_file, dest_stat):
+        """ True if the content file parses exactly as it did when dest_file
+        was last rendered from it. Then dest_file is queued for
+        mark_outputs_current, so the next build can go by mtimes again."""
+        cached = content_cache.get(self.content_file)
+        if cached is None or cached[0] > dest_stat.st_mtime:
+            return False
+        if self.parse_content_file(self.content_file) != cached[2]:
+            return False
+        cached[0], cached[1] = self.content_mtime, self.content_size
+        unchanged_outputs[dest_file] = dest_stat
+        log.debug("content of %s is unchanged", self.content_file)
+        return True
+
     def render(self, template_dict, page_dict):
+        """ render this page to its dest file"""
         self.dest_file = os.path.join(self.dest_path,self.fname)
         dest_file = self.dest_file
-        src_file = self.content_file
-        if os.path.isfile(dest_file) and src_file is not None:
 
-            if os.path.getctime(src_file) > os.path.getctime(dest_file):
-                logging.info(f"incrementally updated src file {src_file}")
-            else:
-                if self.gdict['incremental']:
-                    #logging.info(f"stale {src_file}, skipping")
-                    return
-                    
-        # make a leaf directory
-        self.check_or_create_dir(self.dest_path)
         # copy files
         images, js  = self.copy_media(self.src_path, self.dest_path)
         self.ldict['images'] = images
 
 
-        # render content html through template
-        pagetemplate = Template(self.ldict['content_html'])
-        cooked_html = pagetemplate.render(**self.ldict)
-        self.ldict['content_html'] = cooked_html
+        # render content html through template, if it uses any template
+        # syntax; most content has none and would come out unchanged
+        variables = flatten_ldict(self.ldict)
+        content_html = variables['content_html']
+        if _MAKO_SYNTAX.search(content_html):
+            pagetemplate = _inline_template(content_html)
+            cooked_html = pagetemplate.render(**variables)
+            self.ldict['content_html'] = cooked_html
+            variables['content_html'] = cooked_html
 
 
-        # render template with all variables
+        # render template with all variables, straight to the dest file.
+        # An identical file is left alone and not listed for upload
         try:
-            self.html = self.template.render(**self.ldict)
+            written = self.render_html_file(dest_file, variables)
         except NameError as e:
             if self.tagname is not None:
-                logging.error("template subs in {}".format(self.tagname)) 
+                log.error("template subs in %s", self.tagname) 
             if self.content_file is not None:
-                logging.error("template subs in {}".format(self.content_file)) 
+                log.error("template subs in %s", self.content_file) 
             raise e
-
-        self.modified.append(dest_file)
-        self.write_html_file(dest_file, self.html)
-
-    def copy_if_newer(self, src, dest):
-        # if desitnation exists:
-        if os.path.isfile(dest):
-            if os.path.getctime(src) > os.path.getctime(dest):
-                if os.path.isdir(dest):
-                    dest = os.path.join(dest, os.path.basename(src))
-                shutil.copy(src,dest)
-                self.modified.append(dest)
-        else: 
-            shutil.copy(src,dest)
-            self.modified.append(dest)
+        if written:
+            self.modified.append(dest_file)
+
+    def stale_copy(self, src, dest, src_stat, dest_stats):
+        """ dest + src's name if that copy is missing or stale, else None"""
+        name = os.path.basename(src)
+        dest_stat = dest_stats.get(name)
+        if (dest_stat is None or src_stat.st_mtime > dest_stat.st_mtime
+                or src_stat.st_size != dest_stat.st_size):
+            return dest + name
+        return None
 
     def copy_media(self, src_path, html_path):
         # make a copy of images, etc in local path
         ###print("copy media from  {}  to {}".format(src_path, html_path))
+        # one pass over the directory, sorted afterwards into the order the
+        # per-extension globs used to give
+        media_entries = []
+        js_entries = []
+        entries = (media_entries, js_entries)
+        try:
+            with os.scandir(src_path) as it:
+                for entry in it:
+                    name = entry.name
+                    if name.startswith('.'): # glob's '*' skips dotfiles
+                        continue
+                    cls = _COPY_CLASS.get(os.path.splitext(name)[1])
+                    if cls is not None:
+                        entries[cls[0]].append((cls[1], entry))
+        except OSError:
+            return [], []
+        by_rank = operator.itemgetter(0)
+        media_entries.sort(key=by_rank)
+        js_entries.sort(key=by_rank)
+
+        # the copies already there, from one pass over the destination
+        dest_stats = {}
+        if media_entries or js_entries:
+            try:
+                with os.scandir(html_path) as it:
+                    for entry in it:
+                        if entry.is_file():
+                            dest_stats[entry.name] = entry.stat()
+            except FileNotFoundError:
+                pass
+
+        # (src, dest) of each copy that is out of date. Joined once here,
+        # then each file name is just appended
+        dest_prefix = os.path.join(html_path, '')
+        pending = []
+        def queue_copy(entry):
+            dest = self.stale_copy(entry.path, dest_prefix, entry.stat(), dest_stats)
+            if dest is not None:
+                pending.append((entry.path, dest))
+
         images = []
-        media = ['.jpg', '.jpeg', '.png', '.gif', '.webp',
-                 '.mp3' , '.mp4', '.html', '.pdf', '.svg', '.FCStd']
-        media.extend([s.upper() for s in media])
-        for ext in media:
-            path_glob = os.path.join(src_path, '*' + ext)
-            media_files = glob.glob(path_glob)
-            for f in media_files:
-                #print("   copying {} to {}".format(f, html_path))
-                self.copy_if_newer(f,html_path)
-                root, ext = os.path.splitext(os.path.basename(f))
-                # exclude thumbs from list so we don't render them twice
-                if root != 'thumb':
-                    images.append(os.path.basename(f))
+        for rank, entry in media_entries:
+            if not entry.is_file():
+                continue
+            #print("   copying {} to {}".format(f, html_path))
+            queue_copy(entry)
+            root, ext = os.path.splitext(entry.name)
+            # exclude thumbs from list so we don't render them twice
+            if root != 'thumb':
+                images.append(entry.name)
         js = []
-        for ext in ['.js', '.pde', '.class' ]:
-            path_glob = os.path.join(src_path, '*' + ext)
-            media_files = glob.glob(path_glob)
-            for f in media_files:
-                ###print("   copying {} to {}".format(f, html_path))
-                self.copy_if_newer(f,html_path)
-                js.append(os.path.basename(f))
+        for rank, entry in js_entries:
+            if not entry.is_file():
+                continue
+            ###print("   copying {} to {}".format(f, html_path))
+            queue_copy(entry)
+            js.append(entry.name)
+
+        # copies spend their time in the kernel, so a gallery's worth
+        # overlap well in threads, even inside a render worker
+        if len(pending) > 1:
+            with ThreadPoolExecutor(min(_COPY_THREADS, len(pending))) as ex:
+                for _ in ex.map(shutil.copyfile, *zip(*pending)):
+                    pass
+        elif pending:
+            shutil.copyfile(*pending[0])
+        self.modified.extend(dest for src, dest in pending)
         return images, js
 
-    def check_or_create_dir(self, path):
-        "Create the directory if it does not exist"
-        if not os.path.isdir(path):
-            os.makedirs(path)
-
 if __name__ == '__main__':
     pass